@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class AiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ai'
+
+    def ready(self):
+        from ai import llm
+
+        # Load the tokenizer at startup so the first chat doesn't pay for it
+        if isinstance(llm.get_model(), llm.OpenAI):
+            llm._get_encoding("cl100k_base")
@@ -8,7 +8,10 @@ Description: Wrapper for interactions with LLMs
 
 from __future__ import annotations
 
-import time
+import asyncio
+import bisect
+import functools
+import itertools
 import typing as t
 
 import openai
@@ -16,6 +19,23 @@ import tiktoken
 from django import conf
 
 
+@functools.lru_cache(maxsize=4)
+def _get_encoding(name: str) -> tiktoken.Encoding:
+    """Get the tiktoken encoding, loading the BPE ranks only once per name."""
+
+    return tiktoken.get_encoding(name)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_client(api_key: str) -> openai.AsyncOpenAI:
+    """Get the shared OpenAI client, so connections are pooled across requests."""
+
+    return openai.AsyncOpenAI(
+        api_key=api_key,
+        timeout=60 * 4,  # 4 Minutes
+    )
+
+
 def get_model():
     model = getattr(conf.settings, "LLM_MODEL", "Stub")
 
@@ -31,39 +51,69 @@ class Message(t.TypedDict):
 
     role: t.Literal["user", "system", "assistant"]
     content: str
+    token_count: t.NotRequired[int]
+
+
+@functools.lru_cache(maxsize=32)
+def _context_tokens(context: str) -> int:
+    """Count the tokens in a bot context.
+
+    The same context is sent with every prompt to a bot, so its count is
+    reused between requests.
+    """
+
+    return len(_get_encoding("cl100k_base").encode(context, disallowed_special=()))
 
 
 class LLMAdapter:
     def make_response(
         self, context: str, history: list[Message], prompt: str
-    ) -> t.Generator[str, None, None]:
+    ) -> t.AsyncGenerator[str, None]:
         """Generate a response based on the context, history, and prompt."""
 
         raise NotImplementedError()
 
 
 class Stub(LLMAdapter):
-    def make_response(self, context, history, prompt):
-        time.sleep(1)
+    async def make_response(self, context, history, prompt):
+        await asyncio.sleep(1)
         yield "Hello "
-        time.sleep(2)
+        await asyncio.sleep(2)
         yield "World!"
 
 
 class OpenAI(LLMAdapter):
-    @property
+    TOKENS_PER_MESSAGE = 3
+    """Avg. Overhead for a message."""
+
+    PRIMING = 3
+    """The startup token amount."""
+
+    @functools.cached_property
     def max_tokens(self) -> int:
         """Max tokens allowed."""
 
         return getattr(conf.settings, "OPENAI_MAX_TOKENS", 8_000)
 
-    @property
+    @functools.cached_property
     def model(self) -> str:
         """Model to query."""
 
         return getattr(conf.settings, "OPENAI_MODEL", "gpt-4.1-mini")
 
-    @property
+    @functools.cached_property
+    def history_chunk_size(self) -> int:
+        """Number of history messages the window start moves by."""
+
+        return getattr(conf.settings, "OPENAI_HISTORY_CHUNK_SIZE", 10)
+
+    @functools.cached_property
+    def tokenizer_threads(self) -> int:
+        """Threads used to tokenize a batch of messages."""
+
+        return getattr(conf.settings, "OPENAI_TOKENIZER_THREADS", 4)
+
+    @functools.cached_property
     def api_key(self) -> str:
         """API Key for Open AI."""
 
@@ -75,53 +125,84 @@ class OpenAI(LLMAdapter):
     def _count_token(self, messages: list[Message]):
         """Count the tokens for the given messages."""
 
-        encoding = tiktoken.get_encoding("cli100k_base")
+        encoding = _get_encoding("cl100k_base")
 
-        # Avg. Overhead for a message
-        tokens_per_message = 3
-        # The startup token amount
-        priming = 3
+        # Only encode messages we haven't counted before, caching the
+        # result on the message itself so later counts are free.
+        uncounted = [m for m in messages if "token_count" not in m]
+        texts = [m["content"] for m in uncounted]
 
-        return sum(
-            (tokens_per_message + len(encoding.encode(m["content"])) for m in messages)
-            + priming
-        )
+        # Batches are encoded on a thread pool, which only pays for itself
+        # when there are several messages to encode at once.
+        if len(texts) > 1:
+            tokens = encoding.encode_batch(
+                texts, num_threads=self.tokenizer_threads, disallowed_special=()
+            )
+        else:
+            tokens = [encoding.encode(text, disallowed_special=()) for text in texts]
+
+        for message, encoded in zip(uncounted, tokens):
+            message["token_count"] = self.TOKENS_PER_MESSAGE + len(encoded)
+
+        return self.PRIMING + sum(m["token_count"] for m in messages)
 
     def _truncate_history(self, context: str, history: list[Message], prompt: str):
         """Truncate the history to fit within the token limit."""
 
-        system_msg = Message(role="system", content=context)
+        system_msg = Message(
+            role="system",
+            content=context,
+            token_count=self.TOKENS_PER_MESSAGE + _context_tokens(context),
+        )
         user_msg = Message(role="user", content=prompt)
 
-        trimmed_history = history[:]
+        # The system and user messages are always sent, so whatever
+        # is left of the budget is what the history can use.
+        budget = self.max_tokens - self._count_token([system_msg, user_msg])
 
-        # We utilize the fact Python stores a reference here
-        # to mutate the messages list in the following while loop
-        messages = [system_msg] + trimmed_history + [user_msg]
+        if budget <= 0:
+            return []
 
-        while self._count_token(messages) >= self.max_tokens:
-            if len(trimmed_history) == 0:
-                return []
+        # Tokenize the history once, caching counts on each message.
+        self._count_token(history)
 
-            trimmed_history.pop(0)
+        # tails[k] is the token count of the last k + 1 messages. It is
+        # ascending, so we can binary search for how many messages fit.
+        tails = list(itertools.accumulate(m["token_count"] for m in reversed(history)))
+        keep = bisect.bisect_left(tails, budget)
 
-        return trimmed_history
+        # Start the window on a chunk boundary rather than at the oldest
+        # message that fits. The start then stays put as the chat grows,
+        # so consecutive prompts share a prefix for OpenAI's prompt cache.
+        # Chunks are capped at half of what fits, so we keep at least half.
+        chunk = max(1, min(self.history_chunk_size, keep // 2))
+        start = -(-(len(history) - keep) // chunk) * chunk
 
-    def make_response(self, context, history, prompt):
-        client = openai.Client(
-            api_key=self.api_key,
-            timeout=60 * 4,  # 4 Minutes
-        )
+        return history[start:]
+
+    async def make_response(self, context, history, prompt):
+        client = _get_client(self.api_key)
         system_msg = Message(role="system", content=context)
         user_msg = Message(role="user", content=prompt)
 
-        trimmed_history = self._truncate_history(context, history, prompt)
+        # Tokenizing is CPU bound, so keep it off of the event loop
+        trimmed_history = await asyncio.to_thread(
+            self._truncate_history, context, history, prompt
+        )
 
-        for choice in client.chat.completions.create(
-            messages=[system_msg, *trimmed_history, user_msg],
+        stream = await client.chat.completions.create(
+            messages=[
+                Message(role=m["role"], content=m["content"])
+                for m in [system_msg, *trimmed_history, user_msg]
+            ],
             model=self.model,
             stream=True,
-        ):
-            delta = choice.choices[0].delta
-            if delta and delta.content:
-                yield delta.content
+        )
+
+        # If this generator is closed early (i.e. the user disconnected),
+        # closing the stream drops the connection and stops generation.
+        async with stream:
+            async for choice in stream:
+                delta = choice.choices[0].delta
+                if delta and delta.content:
+                    yield delta.content
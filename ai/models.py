@@ -8,7 +8,7 @@ Description: Models for AI Project
 
 from __future__ import annotations
 
-import itertools
+import contextlib
 import typing as t
 
 from django.contrib.auth import get_user_model
@@ -25,6 +25,15 @@ UserModel = get_user_model()
 
 # Create your models here.
 
+
+def _is_member(user: UserModel, group_ref: str) -> models.Exists:
+    """Check whether the user belongs to the group referenced by ``group_ref``."""
+
+    return models.Exists(
+        UserModel.objects.filter(pk=user.pk, groups=models.OuterRef(group_ref))
+    )
+
+
 ### CourseBot ###
 
 
@@ -41,6 +50,11 @@ class CourseBotQuerySet(models.QuerySet["CourseBot"]):
 
         return self.filter(group__user__in=[user])
 
+    def with_membership(self, user: UserModel):
+        """Annotate whether the user is a member of the CourseBot's group."""
+
+        return self.annotate(is_member=_is_member(user, "group"))
+
     def create_course_bot(self, name: str, context: str):
         """Create a Course Bot."""
 
@@ -98,10 +112,17 @@ class PromptQuerySet(models.QuerySet["Prompt"]):
 
         return self.filter(bot=bot)
 
+    def with_bot_membership(self, user: UserModel):
+        """Select the prompt's bot and annotate whether the user is a member of it."""
+
+        return self.select_related("bot").annotate(
+            is_member=_is_member(user, "bot__group")
+        )
+
     def with_response(self):
         """Filter and annotate the prompt with its associated response."""
 
-        return self.filter(response__isnull=False).prefetch_related("response")
+        return self.filter(response__isnull=False).select_related("response")
 
 
 class Prompt(models.Model):
@@ -145,35 +166,34 @@ class Prompt(models.Model):
 class ResponseQuerySet(models.QuerySet["Response"]):
     """Custom Queryset for Response."""
 
-    def generate(self, bot: CourseBot, prompt: Prompt) -> t.Generator[str, None, None]:
+    async def generate(
+        self, bot: CourseBot, prompt: Prompt
+    ) -> t.AsyncGenerator[str, None]:
         """Generate a response stream."""
 
         model = llm.get_model()
-        history = list(
-            itertools.chain(
-                [
-                    {"role": "user", "content": p.body},
-                    {"role": "assistant", "content": p.response.body},
-                ]
-                for p in Prompt.objects.for_bot(bot)
-                .for_user(prompt.user)
-                .with_response()
+        history = [
+            message
+            async for p in Prompt.objects.for_bot(bot)
+            .filter(user_id=prompt.user_id)
+            .with_response()
+            .order_by("created_at")
+            for message in (
+                {"role": "user", "content": p.body},
+                {"role": "assistant", "content": p.response.body},
             )
-        )
-        iterator = model.make_response(bot.context, history, prompt.body)
-
+        ]
         response_data = []
 
-        while True:
-            try:
-                line = next(iterator)
+        async with contextlib.aclosing(
+            model.make_response(bot.context, history, prompt.body)
+        ) as iterator:
+            async for line in iterator:
                 response_data.append(line)
                 yield line
-            except StopIteration:
-                break
 
         res = self.model(bot=bot, body="".join(response_data), prompt=prompt)
-        res.save()
+        await res.asave()
 
 
 class Response(models.Model):
@@ -1,3 +1,112 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, override_settings
+
+from ai import llm
+
+
+class WordEncoding:
+    """A stand-in for a tiktoken encoding where every word is one token."""
+
+    def encode(self, text, **kwargs):
+        return text.split()
+
+    def encode_batch(self, texts, **kwargs):
+        return [self.encode(text) for text in texts]
+
+
+def make_history(n: int) -> list[llm.Message]:
+    """Make n one word messages, each costing 4 tokens."""
+
+    return [llm.Message(role="user", content=f"m{i}") for i in range(n)]
+
+
+class TruncateHistoryTestCase(SimpleTestCase):
+    """Tests for the OpenAI adapter's history truncation.
+
+    With the word encoding the system and user messages cost 4 tokens each
+    and priming costs 3, so 11 tokens are always used before any history.
+    """
+
+    def setUp(self):
+        patcher = mock.patch.object(llm, "_get_encoding", return_value=WordEncoding())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        llm._context_tokens.cache_clear()
+        self.addCleanup(llm._context_tokens.cache_clear)
+
+    def truncate(self, history: list[llm.Message]) -> list[llm.Message]:
+        return llm.OpenAI()._truncate_history("context", history, "prompt")
+
+
+@override_settings(OPENAI_HISTORY_CHUNK_SIZE=1)
+class TruncateHistoryBudgetTestCase(TruncateHistoryTestCase):
+    def test_everything_fits(self):
+        history = make_history(4)
+
+        with override_settings(OPENAI_MAX_TOKENS=1_000):
+            self.assertEqual(self.truncate(history), history)
+
+    def test_empty_history(self):
+        with override_settings(OPENAI_MAX_TOKENS=1_000):
+            self.assertEqual(self.truncate([]), [])
+
+    def test_nothing_fits(self):
+        for max_tokens in (5, 11):
+            with self.subTest(max_tokens=max_tokens):
+                with override_settings(OPENAI_MAX_TOKENS=max_tokens):
+                    self.assertEqual(self.truncate(make_history(4)), [])
+
+    def test_only_fixed_messages_fit(self):
+        with override_settings(OPENAI_MAX_TOKENS=15):
+            self.assertEqual(self.truncate(make_history(4)), [])
+
+    def test_exact_boundary_is_dropped(self):
+        history = make_history(2)
+
+        # The full request is 19 tokens, which must be under the limit
+        with override_settings(OPENAI_MAX_TOKENS=19):
+            self.assertEqual(self.truncate(history), history[1:])
+
+        with override_settings(OPENAI_MAX_TOKENS=20):
+            self.assertEqual(self.truncate(history), history)
+
+    def test_keeps_most_recent_messages(self):
+        history = make_history(10)
+
+        # 24 tokens of budget leaves room for 5 messages
+        with override_settings(OPENAI_MAX_TOKENS=35):
+            self.assertEqual(self.truncate(history), history[5:])
+
+
+@override_settings(OPENAI_HISTORY_CHUNK_SIZE=4, OPENAI_MAX_TOKENS=47)
+class TruncateHistoryWindowTestCase(TruncateHistoryTestCase):
+    """Tests for the chunk aligned window, where 8 messages fit the budget."""
+
+    def test_window_start_stays_fixed_as_turns_are_appended(self):
+        history = make_history(12)
+
+        before = self.truncate(history[:10])
+        after = self.truncate(history)
+
+        self.assertEqual(before, history[4:10])
+        self.assertEqual(after, history[4:12])
+        self.assertEqual(after[: len(before)], before)
+
+    def test_window_start_moves_by_a_chunk(self):
+        history = make_history(14)
+
+        self.assertEqual(self.truncate(history), history[8:])
+
+    def test_window_fits_the_budget(self):
+        for n in range(20):
+            with self.subTest(n=n):
+                self.assertLessEqual(len(self.truncate(make_history(n))), 8)
+
+    @override_settings(OPENAI_HISTORY_CHUNK_SIZE=10, OPENAI_MAX_TOKENS=31)
+    def test_chunk_is_capped_at_half_of_what_fits(self):
+        history = make_history(7)
+
+        # 4 messages fit, so the chunk is capped at 2 rather than 10
+        self.assertEqual(self.truncate(history), history[4:])
@@ -6,15 +6,18 @@ Date:        2025-08-14
 Description: The views for the Concordia AI project
 """
 
-import json
+import contextlib
+import typing as t
 
+import orjson
 from django import conf, http, shortcuts, urls
 from django.contrib.auth import decorators as auth_decorators
 from django.contrib.auth import get_user_model, login, logout
 from django.contrib.auth import mixins as auth_mixins
-from django.core import serializers
+from django.core import cache, serializers
 from django.utils import decorators
 from django.views import generic
+from django.views.decorators import cache as cache_decorators
 from django.views.decorators import csrf as csrf_decorators
 from django.views.decorators import http as http_decorators
 from onelogin.saml2 import auth, constants, idp_metadata_parser, settings, utils
@@ -34,6 +37,7 @@ class SAMLMixin:
     """
 
     timeout = 60 * 4  # 4 Minutes
+    metadata_cache_timeout = 60 * 60  # 1 Hour
 
     @property
     def metadata_url(self) -> str:
@@ -45,18 +49,25 @@ class SAMLMixin:
             "https": "on" if self.request.is_secure() else "off",
             "http_host": self.request.META["HTTP_HOST"],
             "script_name": self.request.META["PATH_INFO"],
-            "get_data": self.request.GET.copy(),
+            # python3-saml only reads these, so the (immutable) QueryDicts
+            # can be passed through without copying them.
+            "get_data": self.request.GET,
             # Uncomment if using ADFS as IdP, https://github.com/onelogin/python-saml/pull/144
             # 'lowercase_urlencoding': True,
-            "post_data": self.request.POST.copy(),
+            "post_data": self.request.POST,
         }
         return result
 
     def build_saml_config(self):
         """Build a valid SAML Configuration."""
 
-        idp_data = idp_metadata_parser.OneLogin_Saml2_IdPMetadataParser.parse_remote(
-            self.metadata_url, timeout=self.timeout
+        # IdP metadata rarely changes, so avoid fetching it on every request.
+        idp_data = cache.cache.get_or_set(
+            "saml_idp_metadata_v1",
+            lambda: idp_metadata_parser.OneLogin_Saml2_IdPMetadataParser.parse_remote(
+                self.metadata_url, timeout=self.timeout
+            ),
+            self.metadata_cache_timeout,
         )
 
         config = {
@@ -84,8 +95,6 @@ class SAMLMixin:
             },
         } | idp_data
 
-        print(config)
-
         return config
 
     def init_auth(self):
@@ -100,6 +109,7 @@ class SAMLMixin:
 ### SAML Views ###
 
 
+@decorators.method_decorator(cache_decorators.cache_page(60 * 60), name="dispatch")
 class SAMLMetadataView(SAMLMixin, generic.View):
     """SAML Metadata URL."""
 
@@ -115,9 +125,7 @@ class SAMLMetadataView(SAMLMixin, generic.View):
         errors = saml_settings.validate_metadata(metadata)
 
         if len(errors) > 0:
-            response = http.HttpResponseServerError(content={"errors": errors})
-            response.headers["Content-Type"] = "application/json"
-            return response
+            return http.JsonResponse({"errors": errors}, status=500)
 
         response = http.HttpResponse(content=metadata)
         response.headers["Content-Type"] = "text/xml"
@@ -167,18 +175,21 @@ class SAMLAcsView(SAMLMixin, generic.View):
             "http://schemas.xmlsoap.org/ws/2005/05/identity/claims/surname"
         )
 
-        if user := UserModel.objects.get(username=email):
-            login(self.request, user)
-        else:
-            user = UserModel.objects.create_user(
-                email=email,
-                username=email,
-                first_name=first_name[0],
-                last_name=last_name[0],
-                password="Nothing",
-            )
+        user, created = UserModel.objects.get_or_create(
+            username=email,
+            defaults={
+                "email": email,
+                "first_name": (first_name or [""])[0],
+                "last_name": (last_name or [""])[0],
+            },
+        )
+
+        # Users only ever authenticate through SAML
+        if created:
+            user.set_unusable_password()
+            user.save(update_fields=["password"])
 
-            login(self.request, user)
+        login(self.request, user)
 
         return shortcuts.redirect(conf.settings.REDIRECT_URL)
 
@@ -282,40 +293,75 @@ class CourseBotChatView(
     template_name = "ai/coursebot_chat.html"
     context_object_name = "bot"
 
+    def get_queryset(self):
+        return models.CourseBot.objects.with_membership(self.request.user)
+
+    def get_object(self, queryset=None):
+        # Both test_func and get need the bot, so only query for it once
+        if not hasattr(self, "object"):
+            self.object = super().get_object(queryset)
+
+        return self.object
+
     def test_func(self):
-        return self.get_object().group.user_set.contains(self.request.user)
+        return self.get_object().is_member
 
 
 ### AI API Views ###
 
 
+async def event_stream(
+    tokens: t.AsyncGenerator[str, None],
+) -> t.AsyncGenerator[bytes, None]:
+    """Frame a stream of tokens as Server-Sent Events.
+
+    When the client disconnects, the server closes this generator, which
+    in turn closes ``tokens`` so the upstream LLM stream is stopped.
+    """
+
+    async with contextlib.aclosing(tokens):
+        async for token in tokens:
+            yield b"data: " + orjson.dumps({"token": token}) + b"\n\n"
+
+    yield b"data: " + orjson.dumps({"done": True}) + b"\n\n"
+
+
 @auth_decorators.login_required
-def coursebot_chat_history_api_view(request: http.HttpRequest, pk: int):
-    user = request.user
-    course_bot: models.CourseBot = shortcuts.get_object_or_404(models.CourseBot, pk=pk)
+async def coursebot_chat_history_api_view(request: http.HttpRequest, pk: int):
+    user = await request.auser()
+    course_bot: models.CourseBot = await shortcuts.aget_object_or_404(
+        models.CourseBot.objects.with_membership(user), pk=pk
+    )
 
-    if not course_bot.group.user_set.contains(user):
-        response = http.HttpResponse(content={"error": "User cannot view this bot."})
-        response.headers["Content-Type"] = "application/json"
-        response.status_code = 401
-        return response
+    if not course_bot.is_member:
+        return http.JsonResponse({"error": "User cannot view this bot."}, status=401)
 
-    qs = models.Prompt.objects.for_bot(course_bot).for_user(user).with_response()
+    qs = (
+        models.Prompt.objects.for_bot(course_bot)
+        .for_user(user)
+        .with_response()
+        .only("pk", "body", "created_at", "response__body")
+    )
+
+    async def stream_history():
+        """Stream the history as a JSON object, one prompt at a time."""
 
-    data = {
-        prompt.pk: {
+        separator = b""
+        yield b"{"
+        async for prompt in qs.aiterator():
+            entry = {
                 "id": prompt.pk,
                 "body": prompt.body,
                 "createdAt": int(prompt.created_at.timestamp() * 1000),
                 "response": {"body": prompt.response.body} if prompt.response else None,
             }
-        for prompt in qs
-    }
-    print(data)
-    response = http.HttpResponse(content=json.dumps(data))
+            yield b'%s"%d":%s' % (separator, prompt.pk, orjson.dumps(entry))
+            separator = b","
+        yield b"}"
+
+    response = http.StreamingHttpResponse(streaming_content=stream_history())
     response.headers["Content-Type"] = "application/json"
     response.status_code = 200
-    print(response)
     return response
 
 
@@ -323,20 +369,19 @@ def coursebot_chat_history_api_view(request: http.HttpRequest, pk: int):
 @http_decorators.require_POST
 def coursebot_prompt_create_view(request: http.HttpRequest, pk: int):
     user = request.user
-    course_bot: models.CourseBot = shortcuts.get_object_or_404(models.CourseBot, pk=pk)
+    course_bot: models.CourseBot = shortcuts.get_object_or_404(
+        models.CourseBot.objects.with_membership(user), pk=pk
+    )
 
-    if not course_bot.group.user_set.contains(user):
-        response = http.HttpResponse(content={"error": "User cannot view this bot."})
-        response.headers["Content-Type"] = "application/json"
-        response.status_code = 401
-        return response
+    if not course_bot.is_member:
+        return http.JsonResponse({"error": "User cannot view this bot."}, status=401)
 
-    form = forms.PromptForm(course_bot, request, json.loads(request.body))
+    form = forms.PromptForm(course_bot, request, orjson.loads(request.body))
 
     prompt: models.Prompt = form.save()
 
     response = http.HttpResponse(
-        json.dumps(
+        orjson.dumps(
             {
                 "id": prompt.pk,
                 "body": prompt.body,
@@ -352,21 +397,25 @@ def coursebot_prompt_create_view(request: http.HttpRequest, pk: int):
 
 @auth_decorators.login_required
 @http_decorators.require_POST
-def coursebot_prompt_response_create_view(
+async def coursebot_prompt_response_create_view(
     request: http.HttpRequest, pk: int, prompt_pk: int
 ):
-    user = request.user
-    course_bot: models.CourseBot = shortcuts.get_object_or_404(models.CourseBot, pk=pk)
-    prompt: models.Prompt = shortcuts.get_object_or_404(models.Prompt, pk=prompt_pk)
+    user = await request.auser()
+    prompt: models.Prompt = await shortcuts.aget_object_or_404(
+        models.Prompt.objects.with_bot_membership(user), pk=prompt_pk, bot_id=pk
+    )
+    course_bot = prompt.bot
 
-    if not course_bot.group.user_set.contains(user):
-        response = http.HttpResponse(content={"error": "User cannot view this bot."})
-        response.headers["Content-Type"] = "application/json"
-        response.status_code = 401
-        return response
+    if not prompt.is_member:
+        return http.JsonResponse({"error": "User cannot view this bot."}, status=401)
 
     response = http.StreamingHttpResponse(
-        streaming_content=models.Response.objects.generate(course_bot, prompt)
+        streaming_content=event_stream(
+            models.Response.objects.generate(course_bot, prompt)
+        )
     )
-    response.headers["Content-Type"] = "text/plain"
+    response.headers["Content-Type"] = "text/event-stream"
+    # Keep proxies (i.e. nginx) from buffering the stream
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
     return response
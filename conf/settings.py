@@ -40,6 +40,7 @@ ALLOWED_HOSTS = env.list("AI_ALLOWED_HOSTS", default=["*"])
 # Application definition
 
 INSTALLED_APPS = [
+    "daphne",
     "ai",
     "django.contrib.admin",
     "django.contrib.auth",
@@ -79,6 +80,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "conf.wsgi.application"
+ASGI_APPLICATION = "conf.asgi.application"
 
 
 # Database
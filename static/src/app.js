@@ -46,15 +46,35 @@ document.addEventListener("htmx:load", () => {
                 }
             }).then(res => {
                 const reader = res.body.getReader()
+                const decoder = new TextDecoder("utf-8");
+                let buffer = "";
+                let finished = false;
                 pump();
+                function finish() {
+                    if (!finished) {
+                        finished = true;
+                        app.ports.recvResponseFinish.send(-1);
+                    }
+                }
                 function pump() {
                     reader.read().then(({ done, value }) => {
                         if (done) {
-                            app.ports.recvResponseFinish.send(-1);
+                            finish();
                             return;
                         }
-                        const text = new TextDecoder("utf-8").decode(value);
-                        app.ports.recvResponseChunk.send(text);
+                        buffer += decoder.decode(value, { stream: true });
+                        // Server-Sent Events are separated by a blank line
+                        const events = buffer.split("\n\n");
+                        buffer = events.pop();
+                        for (const event of events) {
+                            if (!event.startsWith("data: ")) continue;
+                            const data = JSON.parse(event.slice("data: ".length));
+                            if (data.done) {
+                                finish();
+                            } else {
+                                app.ports.recvResponseChunk.send(data.token);
+                            }
+                        }
                         return pump();
                     })
                 }